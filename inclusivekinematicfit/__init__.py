@@ -4,4 +4,4 @@ from inclusivekinematicfit import funclib
 from inclusivekinematicfit import chi2functions
 from inclusivekinematicfit import utility
 
-from inclusivekinematicfit.chi2functions import minimize
+from inclusivekinematicfit.chi2functions import fit_batch, minimize, minimize_batch
@@ -1,9 +1,13 @@
+import logging
+import multiprocessing
 from abc import ABC, abstractmethod
-from typing import Dict, Any, Union
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, List, Optional, Sequence, Union
 from enum import Enum
 
 import numpy as np
 
+import scipy.linalg
 import scipy.optimize
 
 from inclusivekinematicfit import funclib
@@ -13,11 +17,67 @@ from inclusivekinematicfit.utility import (
     MasslessParticleKinematicInfo,
 )
 
+logger = logging.getLogger(__name__)
+
 
 class Minimizer(Enum):
     SCIPY_SLSQP = "scipy_slsqp"
 
 
+def _as_float_array(values: np.ndarray) -> np.ndarray:
+    return np.ascontiguousarray(values, dtype=np.float64)
+
+
+def _cholesky_factor(covariance_matrix: np.ndarray) -> np.ndarray:
+    """Calculates the lower triangular Cholesky factor of the given covariance
+    matrix, which is used instead of its inverse to calculate the chi square.
+
+    :param covariance_matrix: Covariance matrix
+    :type covariance_matrix: np.ndarray
+    :raises ValueError: Raised if the covariance matrix is not positive definite.
+    :return: Lower triangular Cholesky factor
+    :rtype: np.ndarray
+    """
+    try:
+        return _as_float_array(np.linalg.cholesky(covariance_matrix))
+    except np.linalg.LinAlgError as exc:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Covariance matrix %s with eigenvalues %s not positive definite",
+                covariance_matrix,
+                np.linalg.eigvalsh(covariance_matrix),
+            )
+        raise ValueError("Given Covariance not positive definite") from exc
+
+
+def _check_measured_param_blocks(
+    cov_choleskys: Sequence[np.ndarray], measured_momenta: Sequence[np.ndarray]
+) -> None:
+    """Checks that the measured momenta and the Cholesky factors of their
+    covariance matrices match the fixed blocks of
+    :data:`inclusivekinematicfit.funclib._MEASURED_PARAM_BLOCKS`, in which the
+    whitening matrix is built and which
+    :func:`inclusivekinematicfit.funclib._chi_square_function` reads.
+
+    :param cov_choleskys: Cholesky factors of the covariance matrices of the tag
+    side B meson, the x system and the lepton
+    :type cov_choleskys: Sequence[np.ndarray]
+    :param measured_momenta: Measured momenta in the same order
+    :type measured_momenta: Sequence[np.ndarray]
+    :raises ValueError: Raised if the shapes don't match the blocks.
+    """
+    for (start, stop), cov_cholesky, momentum in zip(
+        funclib._MEASURED_PARAM_BLOCKS, cov_choleskys, measured_momenta
+    ):
+        n_block = stop - start
+        if momentum.size != n_block or cov_cholesky.shape != (n_block, n_block):
+            raise ValueError(
+                f"Expected {n_block} measured parameters with a ({n_block}, "
+                f"{n_block}) covariance matrix, got {momentum.shape} and "
+                f"{cov_cholesky.shape}!"
+            )
+
+
 class AbstractKinematicFitCostFunction(ABC):
     @property
     @abstractmethod
@@ -40,6 +100,9 @@ class AbstractKinematicFitCostFunction(ABC):
 
 
 class SLSQPKinematicFitCostFunction(AbstractKinematicFitCostFunction):
+    # Gradient of the cost function passed to SLSQP, numerically approximated if None
+    gradient = None
+
     def __init__(self):
         self._scipy_slsqp_settings = {"ftol": 1e-9, "disp": False, "maxiter": 500}
 
@@ -47,6 +110,15 @@ class SLSQPKinematicFitCostFunction(AbstractKinematicFitCostFunction):
     def minimizer(self):
         return Minimizer.SCIPY_SLSQP
 
+    @property
+    def slsqp_objective(self):
+        """The objective function, its gradient and the additional arguments
+        passed to both of them by SLSQP. Cost functions can return compiled
+        functions here to avoid the Python method calls of `__call__` and
+        `gradient` on each evaluation.
+        """
+        return self, self.gradient, ()
+
     @property
     def scipy_slsqp_settings(self):
         return self._scipy_slsqp_settings
@@ -77,6 +149,8 @@ class DefaultKinematicFitCostFunction(SLSQPKinematicFitCostFunction):
     n_free_params = 11
     n_constrained_params = 3
     n_fit_params = n_free_params + n_constrained_params
+    # order of the constraints calculated by funclib._fill_eq_constraints
+    eq_constraint_names = ("px", "py", "pz", "E", "mbequal", "mbtag", "mbsig")
 
     def __init__(
         self,
@@ -88,32 +162,149 @@ class DefaultKinematicFitCostFunction(SLSQPKinematicFitCostFunction):
         constraint_list=["px", "py", "pz", "E", "mbsig", "mbtag", "mx2"],
     ):
         super().__init__()
-        self.tag_side_measured_momentum = tag_side_info.four_momentum
-        self.tag_side_cov = tag_side_info.covariance_matrix
-
-        try:
-            self.tag_side_inv_cov = np.linalg.inv(tag_side_info.covariance_matrix)
-        except np.linalg.LinAlgError as exc:
-            print(tag_side_info.covariance_matrix)
-            print(np.linalg.eigvals(tag_side_info.covariance_matrix))
-            raise ValueError(
-                "Given Covariance not invertible"
-            ) from np.linalg.LinAlgError
+        # the compiled functions in funclib expect contiguous float64 arrays
+        self._tag_side_measured_momentum = _as_float_array(tag_side_info.four_momentum)
+        self._tag_side_cov = _as_float_array(tag_side_info.covariance_matrix)
+        self._tag_side_cov_cholesky = _cholesky_factor(self._tag_side_cov)
+
+        self._lepton_measured_three_momentum = _as_float_array(
+            lepton_info.three_momentum
+        )
+        self._lepton_mass = float(lepton_info.mass)
+        self._lepton_cov = _as_float_array(lepton_info.covariance_matrix)
+        self._lepton_cov_cholesky = _cholesky_factor(self._lepton_cov)
 
-        self.lepton_measured_three_momentum = lepton_info.three_momentum
-        self.lepton_mass = lepton_info.mass
-        self.lepton_cov = lepton_info.covariance_matrix
-        self.lepton_inv_cov = np.linalg.inv(lepton_info.covariance_matrix)
+        self._x_system_measured_momentum = _as_float_array(x_system_info.four_momentum)
+        self._x_system_cov = _as_float_array(x_system_info.covariance_matrix)
+        self._x_system_cov_cholesky = _cholesky_factor(self._x_system_cov)
 
-        self.x_system_measured_momentum = x_system_info.four_momentum
-        self.x_system_cov = x_system_info.covariance_matrix
-        self.x_system_inv_cov = np.linalg.inv(x_system_info.covariance_matrix)
+        self._neutrino_measured_three_momentum = _as_float_array(
+            missing_mom_info.three_momentum
+        )
+
+        self._beam_four_momentum = _as_float_array(beam_four_momentum)
+
+        # all measured parameters x[0:11] in one contiguous array with the Cholesky
+        # factor of their block diagonal covariance matrix and its inverse, the
+        # whitening matrix the chi square is evaluated with. Both are filled block
+        # by block, the triangular inverse only has to be calculated once per event.
+        measured_momenta = (
+            self._tag_side_measured_momentum,
+            self._x_system_measured_momentum,
+            self._lepton_measured_three_momentum,
+        )
+        cov_choleskys = (
+            self._tag_side_cov_cholesky,
+            self._x_system_cov_cholesky,
+            self._lepton_cov_cholesky,
+        )
+        _check_measured_param_blocks(cov_choleskys, measured_momenta)
+
+        self._measured_params = np.concatenate(measured_momenta)
+        n_measured = self._measured_params.size
+        cov_cholesky = np.zeros((n_measured, n_measured))
+        whitening_matrix = np.zeros((n_measured, n_measured))
+        for (start, stop), block_cholesky in zip(
+            funclib._MEASURED_PARAM_BLOCKS, cov_choleskys
+        ):
+            block_inverse, _ = scipy.linalg.lapack.dtrtri(block_cholesky, lower=1)
+            cov_cholesky[start:stop, start:stop] = block_cholesky
+            whitening_matrix[start:stop, start:stop] = block_inverse
+        self._measured_params_cov_cholesky = cov_cholesky
+        self._measured_params_whitening_matrix = whitening_matrix
+
+        self._objective_args = (
+            self._measured_params_whitening_matrix,
+            self._measured_params,
+        )
+        self._slsqp_objective = (
+            funclib._chi_square_function,
+            funclib._chi_square_gradient,
+            self._objective_args,
+        )
 
-        self.neutrino_measured_three_momentum = missing_mom_info.three_momentum
+        self._initial_params = np.concatenate(
+            [
+                self._tag_side_measured_momentum,
+                self._x_system_measured_momentum,
+                self._lepton_measured_three_momentum,
+                self._neutrino_measured_three_momentum,
+            ]
+        )
+
+        if self._initial_params.size != self.n_fit_params:
+            raise ValueError(
+                f"Number of initial parameters ({self._initial_params.size}) "
+                f"not compatible with number of fit paramters ({self.n_fit_params})! "
+                "Check initialization of the cost function!"
+            )
 
-        self.beam_four_momentum = beam_four_momentum
+        # setting the constraint list also builds the constraints passed to SLSQP
         self.constraint_list = constraint_list
 
+    # The cached arguments of the compiled functions are built from the inputs when
+    # the cost function is created, so the inputs are read-only. Create a new cost
+    # function for different inputs.
+    @property
+    def tag_side_measured_momentum(self):
+        return self._tag_side_measured_momentum
+
+    @property
+    def tag_side_cov(self):
+        return self._tag_side_cov
+
+    @property
+    def tag_side_cov_cholesky(self):
+        return self._tag_side_cov_cholesky
+
+    @property
+    def lepton_measured_three_momentum(self):
+        return self._lepton_measured_three_momentum
+
+    @property
+    def lepton_mass(self):
+        return self._lepton_mass
+
+    @property
+    def lepton_cov(self):
+        return self._lepton_cov
+
+    @property
+    def lepton_cov_cholesky(self):
+        return self._lepton_cov_cholesky
+
+    @property
+    def x_system_measured_momentum(self):
+        return self._x_system_measured_momentum
+
+    @property
+    def x_system_cov(self):
+        return self._x_system_cov
+
+    @property
+    def x_system_cov_cholesky(self):
+        return self._x_system_cov_cholesky
+
+    @property
+    def neutrino_measured_three_momentum(self):
+        return self._neutrino_measured_three_momentum
+
+    @property
+    def beam_four_momentum(self):
+        return self._beam_four_momentum
+
+    @property
+    def measured_params(self):
+        return self._measured_params
+
+    @property
+    def measured_params_cov_cholesky(self):
+        return self._measured_params_cov_cholesky
+
+    @property
+    def measured_params_whitening_matrix(self):
+        return self._measured_params_whitening_matrix
+
     def x_mom_cons(self, x: np.ndarray):
         return funclib._x_mom_function(x, self.beam_four_momentum)
 
@@ -138,61 +329,117 @@ class DefaultKinematicFitCostFunction(SLSQPKinematicFitCostFunction):
     def x_mass_cons(self, x: np.ndarray) -> float:
         return funclib._x_mass_function(x)
 
+    @property
+    def eq_constraint_args(self):
+        return self._eq_constraint_args
+
+    @property
+    def eq_constraint_index(self) -> np.ndarray:
+        return self._eq_constraint_index
+
+    def _eq_constraint_buffers(self):
+        # output buffers of the compiled constraint functions, new ones for every
+        # call, so that concurrent fits of the same cost function don't share them
+        n_eq = self._eq_constraint_index.size
+        return np.empty(n_eq), np.empty((n_eq, self.n_fit_params))
+
+    def eq_cons(self, x: np.ndarray) -> np.ndarray:
+        return funclib._selected_eq_constraints(
+            x, *self._eq_constraint_args, *self._eq_constraint_buffers()
+        )
+
+    def eq_jac(self, x: np.ndarray) -> np.ndarray:
+        return funclib._selected_eq_constraints_jac(
+            x, *self._eq_constraint_args, *self._eq_constraint_buffers()
+        )
+
     @property
     def initial_params(self):
-        initial_params = np.array(
+        return self._initial_params
+
+    @property
+    def constraint_list(self):
+        return self._constraint_list
+
+    @constraint_list.setter
+    def constraint_list(self, constraint_list):
+        unknown_constraints = set(constraint_list) - {*self.eq_constraint_names, "mx2"}
+        if unknown_constraints:
+            raise ValueError(f"Unknown constraints {sorted(unknown_constraints)}.")
+
+        # all equality constraints are evaluated at once by
+        # funclib._fill_eq_constraints, the selected ones are passed to SLSQP as a
+        # single vector valued constraint. The compiled functions are called
+        # directly by SLSQP with the given args.
+        self._eq_constraint_index = np.array(
             [
-                *self.tag_side_measured_momentum,
-                *self.x_system_measured_momentum,
-                *self.lepton_measured_three_momentum,
-                *self.neutrino_measured_three_momentum,
-            ]
+                self.eq_constraint_names.index(constraint_name)
+                for constraint_name in constraint_list
+                if constraint_name != "mx2"
+            ],
+            dtype=np.int64,
         )
+        self._eq_constraint_args = (
+            self.beam_four_momentum,
+            self.lepton_mass,
+            self._eq_constraint_index,
+        )
+        self._constraint_list = constraint_list
 
-        if initial_params.size != self.n_fit_params:
-            raise ValueError(
-                f"Number of initial parameters ({initial_params.size}) "
-                f"not compatible with number of fit paramters ({self.n_fit_params})! "
-                "Check initialization of the cost function!"
+    @property
+    def constraints(self):
+        # SLSQP copies the constraint values and Jacobians, so both are written to
+        # output buffers instead of new arrays. The constraints are built on every
+        # access, which gives each minimize call its own buffers.
+        constraints = []
+        if self._eq_constraint_index.size > 0:
+            constraints.append(
+                {
+                    "type": "eq",
+                    "fun": funclib._selected_eq_constraints,
+                    "jac": funclib._selected_eq_constraints_jac,
+                    "args": (*self._eq_constraint_args, *self._eq_constraint_buffers()),
+                }
             )
+        if "mx2" in self._constraint_list:
+            constraints.append(
+                {
+                    "type": "ineq",
+                    "fun": funclib._x_mass_function,
+                    "jac": funclib._x_mass_jac,
+                }
+            )
+        return constraints
 
-        return initial_params
+    @property
+    def objective_args(self):
+        return self._objective_args
 
     @property
-    def constraints(self):
+    def slsqp_objective(self):
+        return self._slsqp_objective
 
-        constraint_dict = {
-            "px": {"type": "eq", "fun": self.x_mom_cons},
-            "py": {"type": "eq", "fun": self.y_mom_cons},
-            "pz": {"type": "eq", "fun": self.z_mom_cons},
-            "E": {"type": "eq", "fun": self.E_cons},
-            "mbequal": {"type": "eq", "fun": self.eq_mass_cons},
-            "mbtag": {"type": "eq", "fun": self.tag_mass_cons},
-            "mbsig": {"type": "eq", "fun": self.sig_mass_cons},
-            "mx2": {"type": "ineq", "fun": self.x_mass_cons},
-        }
+    def __call__(self, x: np.ndarray):
+        return funclib._chi_square_function(x, *self._objective_args)
 
-        return [
-            constraint_dict[constraint_name] for constraint_name in self.constraint_list
-        ]
+    def gradient(self, x: np.ndarray) -> np.ndarray:
+        return funclib._chi_square_gradient(x, *self._objective_args)
 
-    def __call__(self, x: np.ndarray):
-        return funclib._objective_function(
-            x,
-            self.tag_side_inv_cov,
-            self.lepton_inv_cov,
-            self.x_system_inv_cov,
-            self.tag_side_measured_momentum,
-            self.lepton_measured_three_momentum,
-            self.x_system_measured_momentum,
-            self.lepton_mass,
-        )
 
+def minimize(
+    cost_function: AbstractKinematicFitCostFunction, x0: Optional[np.ndarray] = None
+):
+    """Minimizes the given cost function with its minimizer.
 
-def minimize(cost_function: AbstractKinematicFitCostFunction,):
+    :param cost_function: Cost function to minimize
+    :type cost_function: AbstractKinematicFitCostFunction
+    :param x0: Initial parameters, e.g. the result of a previous fit of the same
+    event, defaults to the initial parameters of the cost function
+    :type x0: Optional[np.ndarray]
+    """
 
     if cost_function.minimizer == Minimizer.SCIPY_SLSQP:
-        return minimize_with_slsqp(cost_function)
+        return minimize_with_slsqp(cost_function, x0=x0)
     else:
         raise ValueError(
             f"Cost Function has unknown minimizer type: {cost_function.minimizer}"
@@ -200,12 +447,169 @@ def minimize(cost_function: AbstractKinematicFitCostFunction,):
 
 
 def minimize_with_slsqp(
-    cost_function: SLSQPKinematicFitCostFunction,
+    cost_function: SLSQPKinematicFitCostFunction, x0: Optional[np.ndarray] = None
 ) -> scipy.optimize.OptimizeResult:
+    objective_function, objective_gradient, objective_args = (
+        cost_function.slsqp_objective
+    )
+
     return scipy.optimize.minimize(
-        fun=cost_function,
-        x0=cost_function.initial_params,
+        fun=objective_function,
+        x0=cost_function.initial_params if x0 is None else x0,
+        args=objective_args,
         method="SLSQP",
+        jac=objective_gradient,
         constraints=cost_function.constraints,
         options=cost_function.scipy_slsqp_settings,
     )
+
+
+def minimize_batch(
+    cost_functions: Sequence[AbstractKinematicFitCostFunction],
+    max_workers: Optional[int] = None,
+    chunksize: int = 64,
+    x0s: Optional[Sequence[Optional[np.ndarray]]] = None,
+) -> List[scipy.optimize.OptimizeResult]:
+    """Minimizes a batch of independent cost functions, e.g. one per event.
+    The fits are distributed over `max_workers` processes, which default to the
+    number of processors of the machine. With `max_workers=1` the fits are run
+    sequentially in the current process.
+
+    :param cost_functions: Cost functions to minimize
+    :type cost_functions: Sequence[AbstractKinematicFitCostFunction]
+    :param max_workers: Number of worker processes
+    :type max_workers: Optional[int]
+    :param chunksize: Number of cost functions sent to a worker process at once
+    :type chunksize: int
+    :param x0s: Initial parameters of each fit, e.g. the results of previous fits
+    of the same events, see :func:`minimize`
+    :type x0s: Optional[Sequence[Optional[np.ndarray]]]
+    :return: Fit results in the order of the given cost functions
+    :rtype: List[scipy.optimize.OptimizeResult]
+    """
+    if x0s is None:
+        x0s = [None] * len(cost_functions)
+    elif len(x0s) != len(cost_functions):
+        raise ValueError(
+            f"Number of initial parameters ({len(x0s)}) not compatible with "
+            f"number of cost functions ({len(cost_functions)})!"
+        )
+
+    if max_workers == 1:
+        return [
+            minimize(cost_function, x0=x0)
+            for cost_function, x0 in zip(cost_functions, x0s)
+        ]
+
+    # the workers are spawned, since forking after the numba threading layer
+    # of fit_batch has started can leave the workers deadlocked
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        return list(executor.map(minimize, cost_functions, x0s, chunksize=chunksize))
+
+
+def fit_batch(
+    cost_functions: Sequence[DefaultKinematicFitCostFunction],
+    x0s: Optional[np.ndarray] = None,
+    max_iterations: int = 50,
+    tolerance: float = 1e-8,
+) -> List[scipy.optimize.OptimizeResult]:
+    """Fits a batch of cost functions with the same constraints in a single
+    parallel numba call, using the Lagrange multiplier method of
+    :func:`inclusivekinematicfit.funclib._fit_batch` instead of SLSQP. The
+    inequality constraint `mx2` is handled with an active set: fits ending at a
+    negative x system mass squared are refitted with the mass squared fixed to
+    zero, which is successful if its Lagrange multiplier shows that the
+    constraint is binding. Fits that are not successful can be refitted with
+    :func:`minimize_batch`.
+
+    :param cost_functions: Cost functions to minimize
+    :type cost_functions: Sequence[DefaultKinematicFitCostFunction]
+    :param x0s: Initial parameters of shape (N, 14), defaults to the initial
+    parameters of the cost functions
+    :type x0s: Optional[np.ndarray]
+    :param max_iterations: Maximum number of iterations per fit, the refit of
+    an active `mx2` constraint has its own iterations
+    :type max_iterations: int
+    :param tolerance: Tolerance on the constraints and the parameter steps
+    :type tolerance: float
+    :raises ValueError: Raised if the cost functions don't share a constraint
+    list with at least one equality constraint.
+    :return: Fit results in the order of the given cost functions
+    :rtype: List[scipy.optimize.OptimizeResult]
+    """
+    if not cost_functions:
+        return []
+
+    constraint_list = list(cost_functions[0].constraint_list)
+    if any(list(cf.constraint_list) != constraint_list for cf in cost_functions):
+        raise ValueError("All cost functions of a batch need the same constraints!")
+    constraint_index = cost_functions[0].eq_constraint_index
+    if constraint_index.size == 0:
+        raise ValueError("At least one equality constraint is required!")
+
+    if x0s is None:
+        x0s = np.stack([cf.initial_params for cf in cost_functions])
+    x0s = _as_float_array(x0s)
+    if x0s.shape != (len(cost_functions), DefaultKinematicFitCostFunction.n_fit_params):
+        raise ValueError(
+            f"Shape of the initial parameters {x0s.shape} not compatible with "
+            f"number of cost functions ({len(cost_functions)})!"
+        )
+
+    event_args = (
+        np.stack([cf.measured_params_whitening_matrix for cf in cost_functions]),
+        np.stack([cf.measured_params for cf in cost_functions]),
+        np.stack([cf.beam_four_momentum for cf in cost_functions]),
+        np.array([cf.lepton_mass for cf in cost_functions], dtype=np.float64),
+    )
+    x, chi_square, n_iterations, converged, _ = funclib._fit_batch(
+        x0s, *event_args, constraint_index, max_iterations, tolerance
+    )
+
+    success = converged.copy()
+    # refits of an active mx2 constraint that converged to a non binding constraint
+    inactive_refit = np.zeros(len(cost_functions), dtype=bool)
+    if "mx2" in constraint_list:
+        x_mass_sq = x[:, 7] ** 2 - np.sum(x[:, 4:7] ** 2, axis=1)
+        active = converged & (x_mass_sq < -tolerance)
+        if np.any(active):
+            (
+                x[active],
+                chi_square[active],
+                active_n_iterations,
+                converged[active],
+                multipliers,
+            ) = funclib._fit_batch(
+                x[active],
+                *(arg[active] for arg in event_args),
+                np.append(constraint_index, funclib._X_MASS_SQ_CONSTRAINT),
+                max_iterations,
+                tolerance,
+            )
+            n_iterations[active] += active_n_iterations
+            # the constraint is binding, i.e. the chi square decreases towards
+            # negative mass squares, only if its multiplier is not positive
+            binding = multipliers[:, -1] <= 0
+            success[active] = converged[active] & binding
+            inactive_refit[active] = converged[active] & ~binding
+
+    results = []
+    for i in range(len(cost_functions)):
+        if success[i]:
+            message = "Optimization terminated successfully"
+        elif inactive_refit[i]:
+            message = "mx2 constraint not active at refit solution"
+        else:
+            message = "Fit did not converge"
+        results.append(
+            scipy.optimize.OptimizeResult(
+                x=x[i],
+                fun=chi_square[i],
+                nit=n_iterations[i],
+                success=bool(success[i]),
+                message=message,
+            )
+        )
+    return results
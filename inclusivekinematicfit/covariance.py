@@ -2,16 +2,17 @@
 """
 from typing import List, Callable, Dict, Tuple
 
+import numba
 import numpy as np
 import pandas as pd
 
-from inclusivekinematicfit.utility import rms
-
 
 __all__ = [
     "number_of_off_diagonal_values",
     "create_symmetric_matrix",
     "get_covariance_by_phase_space",
+    "get_stacked_covariance_by_phase_space",
+    "get_gaussian_cov_matrix_by_phase_space",
     "get_rms_diag_error_matrix",
     "get_rms_error_matrix",
     "get_gaussian_cov_matrix",
@@ -31,6 +32,24 @@ def number_of_off_diagonal_values(dimension: int) -> int:
     return ((dimension * dimension) - dimension) // 2
 
 
+@numba.njit(cache=True)
+def _fill_symmetric_matrix(
+    dimension: int, diag_values: np.ndarray, off_diag_values: np.ndarray
+) -> np.ndarray:
+    """Fills a symmetric matrix row by row, see :func:`create_symmetric_matrix`."""
+    m = np.zeros((dimension, dimension))
+
+    k = 0
+    for i in range(dimension):
+        m[i, i] = diag_values[i]
+        for j in range(i + 1, dimension):
+            m[i, j] = off_diag_values[k]
+            m[j, i] = off_diag_values[k]
+            k += 1
+
+    return m
+
+
 def create_symmetric_matrix(
     dimension: int, diag_values: np.ndarray, off_diag_values: np.ndarray
 ) -> np.ndarray:
@@ -44,8 +63,6 @@ def create_symmetric_matrix(
     :param off_diag_values: [description]
     :type off_diag_values: np.ndarray
     """
-    m = np.zeros((dimension, dimension), dtype=np.double)
-
     if len(diag_values.shape) != 1 or len(off_diag_values.shape) != 1:
         raise ValueError("Shape of given matrix elements has to be 1-dimensional")
 
@@ -59,14 +76,11 @@ def create_symmetric_matrix(
             "Number of given off diagonal values not compatible with matrix dimension"
         )
 
-    row_diag, column_diag = np.diag_indices(dimension)
-    row_off_diag, column_off_diag = np.triu_indices(dimension, k=1)
-
-    m[row_diag, column_diag] = diag_values
-    m[row_off_diag, column_off_diag] = off_diag_values
-    m[column_off_diag, row_off_diag] = off_diag_values
-
-    return m
+    return _fill_symmetric_matrix(
+        dimension,
+        diag_values.astype(np.double, copy=False),
+        off_diag_values.astype(np.double, copy=False),
+    )
 
 
 def get_covariance_by_phase_space(
@@ -83,26 +97,140 @@ def get_covariance_by_phase_space(
     return cov_mat_dict
 
 
+def get_stacked_covariance_by_phase_space(
+    df: pd.DataFrame,
+    phase_space_bin_columns: List[str],
+    cov_mat_estimator: Callable[[pd.DataFrame], np.ndarray],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Estimates the covariance matrices in each phase space bin like
+    :func:`get_covariance_by_phase_space`, but returns them stacked in a
+    single contiguous array together with the bin index of each row of `df`.
+
+    :param df: Input data
+    :type df: pd.DataFrame
+    :param phase_space_bin_columns: Columns defining the phase space bins
+    :type phase_space_bin_columns: List[str]
+    :param cov_mat_estimator: Function estimating the covariance matrix of a bin
+    :type cov_mat_estimator: Callable[[pd.DataFrame], np.ndarray]
+    :return: Covariance matrices of shape (K, D, D) with the K bins sorted by their
+    group key, and the bin index of each row of shape (N,), which is -1 for rows
+    not belonging to any bin
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+    df_grouped = df.groupby(phase_space_bin_columns)
+
+    cov_mats = np.stack(
+        [cov_mat_estimator(group_df) for _, group_df in df_grouped]
+    ).astype(np.float64, copy=False)
+    bin_index = df_grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+
+    return cov_mats, bin_index
+
+
+@numba.njit(cache=True)
+def _binned_scatter_matrices(
+    values: np.ndarray, bin_index: np.ndarray, n_bins: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Calculates the number of rows and the scatter matrix, i.e. the sum of the
+    outer products of the mean-subtracted rows, of each bin in two passes over
+    the rows. Rows with a negative bin index are skipped.
+    """
+    n_rows, dimension = values.shape
+
+    counts = np.zeros(n_bins)
+    means = np.zeros((n_bins, dimension))
+    for row in range(n_rows):
+        k = bin_index[row]
+        if k < 0:
+            continue
+        counts[k] += 1
+        for i in range(dimension):
+            means[k, i] += values[row, i]
+
+    for k in range(n_bins):
+        if counts[k] > 0:
+            for i in range(dimension):
+                means[k, i] /= counts[k]
+
+    scatter = np.zeros((n_bins, dimension, dimension))
+    for row in range(n_rows):
+        k = bin_index[row]
+        if k < 0:
+            continue
+        for i in range(dimension):
+            residual = values[row, i] - means[k, i]
+            for j in range(i, dimension):
+                scatter[k, i, j] += residual * (values[row, j] - means[k, j])
+
+    for k in range(n_bins):
+        for i in range(dimension):
+            for j in range(i + 1, dimension):
+                scatter[k, j, i] = scatter[k, i, j]
+
+    return counts, scatter
+
+
+def get_gaussian_cov_matrix_by_phase_space(
+    df: pd.DataFrame,
+    phase_space_bin_columns: List[str],
+    four_momentum_columns: List[str],
+) -> Dict[Tuple[pd.Interval, ...], np.ndarray]:
+    """Calculates the same covariance matrices as :func:`get_covariance_by_phase_space`
+    with :func:`get_gaussian_cov_matrix` as estimator, but in a single pass over
+    all rows instead of one estimator call per phase space bin.
+
+    :param df: Input data
+    :type df: pd.DataFrame
+    :param phase_space_bin_columns: Columns defining the phase space bins
+    :type phase_space_bin_columns: List[str]
+    :param four_momentum_columns: Columns of the covariance matrix
+    :type four_momentum_columns: List[str]
+    :return: Covariance matrix of each phase space bin, NaN for bins with less
+    than two rows
+    :rtype: Dict[Tuple[pd.Interval, ...], np.ndarray]
+    """
+    df_grouped = df.groupby(phase_space_bin_columns)
+
+    bin_keys = df_grouped.size().index
+    if not isinstance(bin_keys, pd.MultiIndex):
+        bin_keys = [(bin_key,) for bin_key in bin_keys]
+
+    bin_index = df_grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    values = df.loc[:, four_momentum_columns].to_numpy(dtype=np.float64)
+
+    counts, scatter = _binned_scatter_matrices(values, bin_index, len(bin_keys))
+    # like np.cov, bins with less than two rows (e.g. empty categorical bins) have
+    # no covariance estimate
+    degrees_of_freedom = np.where(counts > 1, counts - 1, np.nan)
+    cov_mats = scatter / degrees_of_freedom[:, np.newaxis, np.newaxis]
+
+    return dict(zip(bin_keys, cov_mats))
+
+
+def _mean_squares(values: np.ndarray) -> np.ndarray:
+    """Calculates the mean of the squared values of each column, i.e. the squared
+    RMS (see :func:`inclusivekinematicfit.utility.rms`), skipping missing values.
+    """
+    return np.nanmean(values * values, axis=0)
+
+
 def get_rms_diag_error_matrix(
     df: pd.DataFrame, four_momentum_columns: List[str]
 ) -> np.ndarray:
-    return (
-        np.diag([rms(df.loc[:, x_var]) for x_var in four_momentum_columns]).astype(
-            np.float64
-        )
-        ** 2
-    )
+    values = df.loc[:, four_momentum_columns].to_numpy(dtype=np.float64)
+    return np.diag(_mean_squares(values))
 
 
 def get_rms_error_matrix(
     df: pd.DataFrame, four_momentum_columns: List[str]
 ) -> np.ndarray:
+    values = df.loc[:, four_momentum_columns].to_numpy(dtype=np.float64)
 
-    diag_rms = np.sqrt((get_rms_diag_error_matrix(df, four_momentum_columns)))
-
-    correlation = np.corrcoef(df.loc[:, four_momentum_columns], rowvar=False)
+    rms_values = np.sqrt(_mean_squares(values))
+    correlation = np.corrcoef(values, rowvar=False)
 
-    return diag_rms @ correlation @ diag_rms
+    # equivalent to diag(rms) @ correlation @ diag(rms)
+    return rms_values[:, np.newaxis] * correlation * rms_values[np.newaxis, :]
 
 
 def get_gaussian_cov_matrix(
@@ -10,10 +10,13 @@ convetion):
     - x[11:14] 3 three momenta componets of the neutrino
 """
 
+import math
+
 import numba
 import numpy as np
 
 __all__ = [
+    "_three_momentum_sq",
     "_x_mom_function",
     "_y_mom_function",
     "_z_mom_function",
@@ -29,14 +32,47 @@ __all__ = [
     "_tag_mass_function",
     "_sig_mass_function",
     "_x_mass_function",
-    "_objective_function",
+    "_fill_eq_constraints",
+    "_fill_eq_constraints_jac",
+    "_selected_eq_constraints",
+    "_selected_eq_constraints_jac",
+    "_chi_square_function",
+    "_x_mass_jac",
+    "_chi_square_gradient",
+    "_add_eq_constraints_hessian",
+    "_merit_function",
+    "_min_reduced_curvature",
+    "_fit_batch",
 ]
 
 
 AVG_B_MASS = 5.279
 
+# fastmath is restricted to flags that keep NaN and inf semantics, so an unphysical
+# (negative) mass squared still propagates as NaN to the minimizer. The numpy
+# error model skips the zero division checks of float divisions.
+_JIT_OPTIONS = dict(
+    cache=True,
+    fastmath={"nsz", "arcp", "contract", "afn", "reassoc"},
+    error_model="numpy",
+)
+
+# Functions called by the minimizer are compiled eagerly for contiguous float64
+# arrays, so each call is dispatched to a single specialization.
+_CHI_SQUARE_ARG_TYPES = "f8[::1], f8[:, ::1], f8[::1]"
+
+# The measured parameters x[0:11] are made up of the tag side B meson, the x system
+# and the lepton momenta. Their joint covariance matrix is block diagonal in these
+# fixed blocks, so the chi square loops only run over the blocks. The cost
+# functions check this layout when building the whitening matrix.
+_MEASURED_PARAM_BLOCKS = ((0, 4), (4, 8), (8, 11))
 
-@numba.jit(nopython=True)
+# Direction of the signal side B meson three momentum each parameter contributes
+# to, -1 for the energies and the tag side B meson.
+_SIG_MOMENTUM_DIRECTION = (-1, -1, -1, -1, 0, 1, 2, -1, 0, 1, 2, 0, 1, 2)
+
+
+@numba.njit(**_JIT_OPTIONS)
 def _x_mom_function(x: np.ndarray, beam_momentum: np.ndarray) -> float:
     """Calculates difference of the total four momentum and the beam
     four momentum x momentum component.
@@ -52,7 +88,7 @@ def _x_mom_function(x: np.ndarray, beam_momentum: np.ndarray) -> float:
     return x[0] + x[4] + x[8] + x[11] - beam_momentum[0]
 
 
-@numba.jit(nopython=True)
+@numba.njit(**_JIT_OPTIONS)
 def _y_mom_function(x: np.ndarray, beam_momentum: np.ndarray) -> float:
     """Calculates difference of the total four momentum and the beam
     four momentum y momentum component.
@@ -68,7 +104,7 @@ def _y_mom_function(x: np.ndarray, beam_momentum: np.ndarray) -> float:
     return x[1] + x[5] + x[9] + x[12] - beam_momentum[1]
 
 
-@numba.jit(nopython=True)
+@numba.njit(**_JIT_OPTIONS)
 def _z_mom_function(x: np.ndarray, beam_momentum: np.ndarray) -> float:
     """Calculates difference of the total four momentum and the
     beam four momentum z momentum component.
@@ -84,7 +120,25 @@ def _z_mom_function(x: np.ndarray, beam_momentum: np.ndarray) -> float:
     return x[2] + x[6] + x[10] + x[13] - beam_momentum[2]
 
 
-@numba.jit(nopython=True)
+@numba.njit(**_JIT_OPTIONS)
+def _three_momentum_sq(x: np.ndarray, offset: int) -> float:
+    """Calculates the squared length of the three momentum x[offset:offset + 3].
+
+    :param x: Parameter array
+    :type x: np.ndarray
+    :param offset: Index of the x component of the three momentum
+    :type offset: int
+    :return: Squared three momentum
+    :rtype: float
+    """
+    return (
+        x[offset] * x[offset]
+        + x[offset + 1] * x[offset + 1]
+        + x[offset + 2] * x[offset + 2]
+    )
+
+
+@numba.njit(**_JIT_OPTIONS)
 def _lepton_energy(x: np.ndarray, lepton_mass: float) -> float:
     """Calculates the lepton energy.
 
@@ -95,10 +149,10 @@ def _lepton_energy(x: np.ndarray, lepton_mass: float) -> float:
     :return: Lepton energy in GeV
     :rtype: float
     """
-    return np.sqrt(np.sum(x[8:11] ** 2) + lepton_mass ** 2)
+    return math.sqrt(_three_momentum_sq(x, 8) + lepton_mass * lepton_mass)
 
 
-@numba.jit(nopython=True)
+@numba.njit(**_JIT_OPTIONS)
 def _neutrino_energy(x: np.ndarray) -> float:
     """Calculates the neutrino energy.
 
@@ -107,10 +161,10 @@ def _neutrino_energy(x: np.ndarray) -> float:
     :return: Neutrino energy in GeV
     :rtype: float
     """
-    return np.sqrt(np.sum(x[11:] ** 2))
+    return math.sqrt(_three_momentum_sq(x, 11))
 
 
-@numba.jit(nopython=True)
+@numba.njit(**_JIT_OPTIONS)
 def _E_function(x: np.ndarray, beam_momentum: np.ndarray, lepton_mass: float) -> float:
     """Calculates difference of the total four momentum and the
     beam four momentum energy momentum component.
@@ -132,7 +186,7 @@ def _E_function(x: np.ndarray, beam_momentum: np.ndarray, lepton_mass: float) ->
     )
 
 
-@numba.jit(nopython=True)
+@numba.njit(**_JIT_OPTIONS)
 def _tag_mass_sq(x: np.ndarray) -> float:
     """Calculates the invariant mass squared of the tag side B meson.
 
@@ -141,10 +195,10 @@ def _tag_mass_sq(x: np.ndarray) -> float:
     :return: Invariant mass squared of the tag side B meson.
     :rtype: float
     """
-    return x[3] ** 2 - np.sum(x[0:3] ** 2)
+    return x[3] * x[3] - _three_momentum_sq(x, 0)
 
 
-@numba.jit(nopython=True)
+@numba.njit(**_JIT_OPTIONS)
 def _sig_x_mom(x: np.ndarray) -> float:
     """Calculates the x component of the signal side
     B meson three momentum.
@@ -158,7 +212,7 @@ def _sig_x_mom(x: np.ndarray) -> float:
     return x[4] + x[8] + x[11]
 
 
-@numba.jit(nopython=True)
+@numba.njit(**_JIT_OPTIONS)
 def _sig_y_mom(x: np.ndarray) -> float:
     """Calculates the y component of the signal side
     B meson three momentum.
@@ -171,7 +225,7 @@ def _sig_y_mom(x: np.ndarray) -> float:
     return x[5] + x[9] + x[12]
 
 
-@numba.jit(nopython=True)
+@numba.njit(**_JIT_OPTIONS)
 def _sig_z_mom(x: np.ndarray) -> float:
     """Calculates the z component of the signal side
     B meson three momentum.
@@ -184,25 +238,31 @@ def _sig_z_mom(x: np.ndarray) -> float:
     return x[6] + x[10] + x[13]
 
 
-@numba.jit(nopython=True)
-def _sig_mass_sq(x: np.ndarray, lepton_mass: float) -> float:
+@numba.njit(**_JIT_OPTIONS)
+def _sig_mass_sq(x: np.ndarray, lepton_energy: float, neutrino_energy: float) -> float:
     """Calculates the invariant mass squared of the signal side
-    B meson.
+    B meson. The lepton and neutrino energies are passed in, so they
+    can be shared with the other constraints evaluated at the same `x`.
 
     :param x: Parameter array
     :type x: np.ndarray
+    :param lepton_energy: Lepton energy (:func:`_lepton_energy`) in GeV
+    :type lepton_energy: float
+    :param neutrino_energy: Neutrino energy (:func:`_neutrino_energy`) in GeV
+    :type neutrino_energy: float
     :return: Invariant mass squared of the signal side B meson.
     :rtype: float
     """
-    return (
-        (x[7] + _lepton_energy(x, lepton_mass) + _neutrino_energy(x)) ** 2
-        - _sig_x_mom(x) ** 2
-        - _sig_y_mom(x) ** 2
-        - _sig_z_mom(x) ** 2
+    sig_energy = x[7] + lepton_energy + neutrino_energy
+    sig_x_mom = _sig_x_mom(x)
+    sig_y_mom = _sig_y_mom(x)
+    sig_z_mom = _sig_z_mom(x)
+    return sig_energy * sig_energy - (
+        sig_x_mom * sig_x_mom + sig_y_mom * sig_y_mom + sig_z_mom * sig_z_mom
     )
 
 
-@numba.jit(nopython=True)
+@numba.njit(**_JIT_OPTIONS)
 def _eq_mass_function(x: np.ndarray, lepton_mass: float) -> float:
     """Calculates the difference between the tag-side and signal
     B meson.
@@ -215,47 +275,661 @@ def _eq_mass_function(x: np.ndarray, lepton_mass: float) -> float:
     B meson
     :rtype: float
     """
-    return np.sqrt(_tag_mass_sq(x)) - np.sqrt(_sig_mass_sq(x, lepton_mass))
+    sig_mass_sq = _sig_mass_sq(x, _lepton_energy(x, lepton_mass), _neutrino_energy(x))
+    return math.sqrt(_tag_mass_sq(x)) - math.sqrt(sig_mass_sq)
 
 
-@numba.jit(nopython=True)
+@numba.njit(**_JIT_OPTIONS)
 def _tag_mass_function(x: np.ndarray) -> float:
-    return np.sqrt(_tag_mass_sq(x)) - AVG_B_MASS
+    return math.sqrt(_tag_mass_sq(x)) - AVG_B_MASS
 
 
-@numba.jit(nopython=True)
+@numba.njit(**_JIT_OPTIONS)
 def _sig_mass_function(x: np.ndarray, lepton_mass: float) -> float:
-    return np.sqrt(_sig_mass_sq(x, lepton_mass)) - AVG_B_MASS
+    sig_mass_sq = _sig_mass_sq(x, _lepton_energy(x, lepton_mass), _neutrino_energy(x))
+    return math.sqrt(sig_mass_sq) - AVG_B_MASS
 
 
-@numba.jit(nopython=True)
+@numba.njit("f8(f8[::1])", **_JIT_OPTIONS)
 def _x_mass_function(x: np.ndarray) -> float:
-    return x[7] ** 2 - np.sum(x[4:7] ** 2)
+    return x[7] * x[7] - _three_momentum_sq(x, 4)
+
+
+# Index of the x system mass squared in _fill_eq_constraints. It is not one of the
+# equality constraints of the cost functions, but is fitted as equality constraint
+# by _fit_batch if the mx2 inequality constraint is active.
+_X_MASS_SQ_CONSTRAINT = 7
+
+
+@numba.njit(**_JIT_OPTIONS)
+def _fill_eq_constraints(
+    x: np.ndarray,
+    beam_momentum: np.ndarray,
+    lepton_mass: float,
+    constraint_index: np.ndarray,
+    out: np.ndarray,
+) -> np.ndarray:
+    """Calculates the equality constraints selected by `constraint_index` into
+    the preallocated array `out`, so the lepton and neutrino energies and the
+    B meson masses are only calculated once and no array is allocated. The
+    constraints are indexed as: x, y, z momentum (:func:`_x_mom_function` etc.),
+    energy (:func:`_E_function`), equal B meson masses (:func:`_eq_mass_function`),
+    tag side B meson mass (:func:`_tag_mass_function`), signal side B meson
+    mass (:func:`_sig_mass_function`) and x system mass squared
+    (:func:`_x_mass_function`).
+
+    :param x: Parameter array
+    :type x: np.ndarray
+    :param beam_momentum: Total beam four momentum
+    :type beam_momentum: np.ndarray
+    :param lepton_mass: Lepton mass (from MC) in GeV
+    :type lepton_mass: float
+    :param constraint_index: Indices of the selected constraints
+    :type constraint_index: np.ndarray
+    :param out: Array of length len(constraint_index) the constraints are written to
+    :type out: np.ndarray
+    :return: `out`
+    :rtype: np.ndarray
+    """
+    lepton_energy = _lepton_energy(x, lepton_mass)
+    neutrino_energy = _neutrino_energy(x)
+    sig_energy = x[7] + lepton_energy + neutrino_energy
+
+    tag_mass = math.sqrt(_tag_mass_sq(x))
+    sig_mass = math.sqrt(_sig_mass_sq(x, lepton_energy, neutrino_energy))
+
+    cons = (
+        x[0] + _sig_x_mom(x) - beam_momentum[0],
+        x[1] + _sig_y_mom(x) - beam_momentum[1],
+        x[2] + _sig_z_mom(x) - beam_momentum[2],
+        x[3] + sig_energy - beam_momentum[3],
+        tag_mass - sig_mass,
+        tag_mass - AVG_B_MASS,
+        sig_mass - AVG_B_MASS,
+        x[7] * x[7] - _three_momentum_sq(x, 4),
+    )
+    for k in range(constraint_index.size):
+        out[k] = cons[constraint_index[k]]
+    return out
 
 
-@numba.jit(nopython=True)
-def _objective_function(
+@numba.njit(**_JIT_OPTIONS)
+def _fill_eq_constraints_jac(
+    x: np.ndarray,
+    beam_momentum: np.ndarray,
+    lepton_mass: float,
+    constraint_index: np.ndarray,
+    out: np.ndarray,
+) -> np.ndarray:
+    """Calculates the Jacobian of :func:`_fill_eq_constraints` into the
+    preallocated array `out`. Only the rows of the selected constraints are
+    calculated.
+
+    :param x: Parameter array
+    :type x: np.ndarray
+    :param beam_momentum: Total beam four momentum
+    :type beam_momentum: np.ndarray
+    :param lepton_mass: Lepton mass (from MC) in GeV
+    :type lepton_mass: float
+    :param constraint_index: Indices of the selected constraints
+    :type constraint_index: np.ndarray
+    :param out: Array of shape (len(constraint_index), 14) the Jacobian is written to
+    :type out: np.ndarray
+    :return: `out`
+    :rtype: np.ndarray
+    """
+    lepton_energy = _lepton_energy(x, lepton_mass)
+    neutrino_energy = _neutrino_energy(x)
+    sig_energy = x[7] + lepton_energy + neutrino_energy
+    sig_three_momentum = (_sig_x_mom(x), _sig_y_mom(x), _sig_z_mom(x))
+
+    tag_mass = math.sqrt(_tag_mass_sq(x))
+    sig_mass = math.sqrt(_sig_mass_sq(x, lepton_energy, neutrino_energy))
+
+    for k in range(constraint_index.size):
+        c = constraint_index[k]
+        row = out[k]
+        row[:] = 0.0
+
+        if c < 3:
+            # momentum conservation
+            row[c] = row[4 + c] = row[8 + c] = row[11 + c] = 1.0
+        elif c == 3:
+            # energy conservation
+            row[3] = row[7] = 1.0
+            for i in range(3):
+                row[8 + i] = x[8 + i] / lepton_energy
+                row[11 + i] = x[11 + i] / neutrino_energy
+        elif c == _X_MASS_SQ_CONSTRAINT:
+            for i in range(4, 7):
+                row[i] = -2 * x[i]
+            row[7] = 2 * x[7]
+        else:
+            if c != 6:
+                # tag side B meson mass, contributes to the constraints 4 and 5
+                for i in range(3):
+                    row[i] = -x[i] / tag_mass
+                row[3] = x[3] / tag_mass
+            if c != 5:
+                # signal side B meson mass, enters constraint 4 with negative sign
+                sign = -1.0 if c == 4 else 1.0
+                scale = sign / sig_mass
+                row[7] = scale * sig_energy
+                for i in range(3):
+                    row[4 + i] = -scale * sig_three_momentum[i]
+                    row[8 + i] = scale * (
+                        sig_energy * x[8 + i] / lepton_energy - sig_three_momentum[i]
+                    )
+                    row[11 + i] = scale * (
+                        sig_energy * x[11 + i] / neutrino_energy - sig_three_momentum[i]
+                    )
+    return out
+
+
+# The selected constraints are passed to the minimizer with the same `args` for
+# the constraint function and its Jacobian, so both take both output buffers.
+_SELECTED_EQ_CONSTRAINTS_ARG_TYPES = (
+    "f8[::1], f8[::1], f8, i8[::1], f8[::1], f8[:, ::1]"
+)
+
+
+@numba.njit(f"f8[::1]({_SELECTED_EQ_CONSTRAINTS_ARG_TYPES})", **_JIT_OPTIONS)
+def _selected_eq_constraints(
     x: np.ndarray,
-    tag_icov: np.ndarray,
-    lep_icov: np.ndarray,
-    x_icov: np.ndarray,
-    tag_meas: np.ndarray,
-    lep_meas: np.ndarray,
-    x_meas: np.ndarray,
-    lep_mass: float,
+    beam_momentum: np.ndarray,
+    lepton_mass: float,
+    constraint_index: np.ndarray,
+    out: np.ndarray,
+    jac_out: np.ndarray,
+) -> np.ndarray:
+    """Calculates the equality constraints selected by `constraint_index`
+    into `out`, see :func:`_fill_eq_constraints`.
+
+    :param x: Parameter array
+    :type x: np.ndarray
+    :param beam_momentum: Total beam four momentum
+    :type beam_momentum: np.ndarray
+    :param lepton_mass: Lepton mass (from MC) in GeV
+    :type lepton_mass: float
+    :param constraint_index: Indices of the selected constraints
+    :type constraint_index: np.ndarray
+    :param out: Output buffer of length len(constraint_index)
+    :type out: np.ndarray
+    :param jac_out: Output buffer of :func:`_selected_eq_constraints_jac`, unused
+    :type jac_out: np.ndarray
+    :return: `out` filled with the selected equality constraints
+    :rtype: np.ndarray
+    """
+    return _fill_eq_constraints(x, beam_momentum, lepton_mass, constraint_index, out)
+
+
+@numba.njit(f"f8[:, ::1]({_SELECTED_EQ_CONSTRAINTS_ARG_TYPES})", **_JIT_OPTIONS)
+def _selected_eq_constraints_jac(
+    x: np.ndarray,
+    beam_momentum: np.ndarray,
+    lepton_mass: float,
+    constraint_index: np.ndarray,
+    out: np.ndarray,
+    jac_out: np.ndarray,
+) -> np.ndarray:
+    """Calculates the Jacobian of :func:`_selected_eq_constraints` into `jac_out`.
+
+    :param x: Parameter array
+    :type x: np.ndarray
+    :param beam_momentum: Total beam four momentum
+    :type beam_momentum: np.ndarray
+    :param lepton_mass: Lepton mass (from MC) in GeV
+    :type lepton_mass: float
+    :param constraint_index: Indices of the selected constraints
+    :type constraint_index: np.ndarray
+    :param out: Output buffer of :func:`_selected_eq_constraints`, unused
+    :type out: np.ndarray
+    :param jac_out: Output buffer of shape (len(constraint_index), 14)
+    :type jac_out: np.ndarray
+    :return: `jac_out` filled with the Jacobian
+    :rtype: np.ndarray
+    """
+    return _fill_eq_constraints_jac(
+        x, beam_momentum, lepton_mass, constraint_index, jac_out
+    )
+
+
+@numba.njit(f"f8({_CHI_SQUARE_ARG_TYPES})", **_JIT_OPTIONS)
+def _chi_square_function(
+    x: np.ndarray, whitening_matrix: np.ndarray, meas: np.ndarray
 ) -> float:
-    tag_side_four_momentum = x[:4]
-    x_system_four_momentum = x[4:8]
-    lepton_three_momentum = x[8:11]
-    neutrino_three_momentum = x[11:14]
+    """Calculates the chi square sum of all measured parameters x[0:11] at once.
+    The covariance matrix is given by the inverse W = L^-1 of its lower
+    triangular Cholesky factor L, so the chi square is the squared norm of W r
+    without any divisions. `meas` holds the measured tag side B meson, x system
+    and lepton momenta and `whitening_matrix` is the inverted Cholesky factor of
+    the block diagonal matrix of their covariance matrices. Only the diagonal
+    blocks `_MEASURED_PARAM_BLOCKS` of W are read, `meas` needs 11 entries.
 
-    tag_side_residuals = tag_side_four_momentum - tag_meas
-    tag_side_chi_square = tag_side_residuals @ tag_icov @ tag_side_residuals
+    :param x: Parameter array
+    :type x: np.ndarray
+    :param whitening_matrix: Inverse of the Cholesky factor of the covariance
+    matrix of all measured parameters
+    :type whitening_matrix: np.ndarray
+    :param meas: Measured values of the parameters
+    :type meas: np.ndarray
+    :return: Chi square sum
+    :rtype: float
+    """
+    chi_square = 0.0
+    for start, stop in _MEASURED_PARAM_BLOCKS:
+        for i in range(start, stop):
+            y = 0.0
+            for j in range(start, i + 1):
+                y += whitening_matrix[i, j] * (x[j] - meas[j])
+            chi_square += y * y
+    return chi_square
 
-    lep_residuals = lepton_three_momentum - lep_meas
-    lepton_chi_square = lep_residuals @ lep_icov @ lep_residuals
 
-    x_system_residuals = x_system_four_momentum - x_meas
-    x_system_chi_square = x_system_residuals @ x_icov @ x_system_residuals
+@numba.njit("f8[::1](f8[::1])", **_JIT_OPTIONS)
+def _x_mass_jac(x: np.ndarray) -> np.ndarray:
+    """Calculates the gradient of :func:`_x_mass_function`.
 
-    return tag_side_chi_square + lepton_chi_square + x_system_chi_square
+    :param x: Parameter array
+    :type x: np.ndarray
+    :return: Gradient with respect to the parameter array
+    :rtype: np.ndarray
+    """
+    jac = np.zeros(x.size)
+    for i in range(4, 7):
+        jac[i] = -2 * x[i]
+    jac[7] = 2 * x[7]
+    return jac
+
+
+@numba.njit(f"f8[::1]({_CHI_SQUARE_ARG_TYPES})", **_JIT_OPTIONS)
+def _chi_square_gradient(
+    x: np.ndarray, whitening_matrix: np.ndarray, meas: np.ndarray
+) -> np.ndarray:
+    """Calculates the gradient 2 * W^T W r of :func:`_chi_square_function`.
+
+    :param x: Parameter array
+    :type x: np.ndarray
+    :param whitening_matrix: Inverse of the Cholesky factor of the covariance
+    matrix of all measured parameters
+    :type whitening_matrix: np.ndarray
+    :param meas: Measured values of the parameters
+    :type meas: np.ndarray
+    :return: Gradient with respect to the parameter array
+    :rtype: np.ndarray
+    """
+    grad = np.zeros(x.size)
+    for start, stop in _MEASURED_PARAM_BLOCKS:
+        for i in range(start, stop):
+            y = 0.0
+            for j in range(start, i + 1):
+                y += whitening_matrix[i, j] * (x[j] - meas[j])
+            y *= 2
+            for j in range(start, i + 1):
+                grad[j] += whitening_matrix[i, j] * y
+    return grad
+
+
+@numba.njit(**_JIT_OPTIONS)
+def _add_eq_constraints_hessian(
+    x: np.ndarray,
+    lepton_mass: float,
+    constraint_index: np.ndarray,
+    multipliers: np.ndarray,
+    out: np.ndarray,
+) -> None:
+    """Adds the Hessians of the equality constraints selected by
+    `constraint_index` weighted with `multipliers` to `out`, i.e. the constraint
+    part of the Hessian of the Lagrangian. The momentum constraints are linear,
+    the energy constraint contributes the Hessians of the lepton and neutrino
+    energies, for the B meson masses m = sqrt(s) the Hessian is
+    (s'' / 2 - m' m'^T) / m and the x system mass squared has a constant Hessian.
+
+    :param x: Parameter array
+    :type x: np.ndarray
+    :param lepton_mass: Lepton mass (from MC) in GeV
+    :type lepton_mass: float
+    :param constraint_index: Indices of the selected constraints
+    :type constraint_index: np.ndarray
+    :param multipliers: Lagrange multipliers of the selected constraints
+    :type multipliers: np.ndarray
+    :param out: Array of shape (14, 14) the weighted Hessians are added to
+    :type out: np.ndarray
+    """
+    energy_weight = 0.0
+    tag_weight = 0.0
+    sig_weight = 0.0
+    x_mass_sq_weight = 0.0
+    for k in range(constraint_index.size):
+        c = constraint_index[k]
+        if c == 3:
+            energy_weight += multipliers[k]
+        elif c == 4:
+            tag_weight += multipliers[k]
+            sig_weight -= multipliers[k]
+        elif c == 5:
+            tag_weight += multipliers[k]
+        elif c == 6:
+            sig_weight += multipliers[k]
+        elif c == _X_MASS_SQ_CONSTRAINT:
+            x_mass_sq_weight += multipliers[k]
+
+    for i in range(4, 7):
+        out[i, i] -= 2 * x_mass_sq_weight
+    out[7, 7] += 2 * x_mass_sq_weight
+
+    lepton_energy = _lepton_energy(x, lepton_mass)
+    neutrino_energy = _neutrino_energy(x)
+    sig_energy = x[7] + lepton_energy + neutrino_energy
+    sig_mass = math.sqrt(_sig_mass_sq(x, lepton_energy, neutrino_energy))
+
+    # the signal side mass contains sig_energy * E'' / m of both energies
+    energy_weight += sig_weight * sig_energy / sig_mass
+    for offset, energy in ((8, lepton_energy), (11, neutrino_energy)):
+        for i in range(offset, offset + 3):
+            out[i, i] += energy_weight / energy
+            for j in range(offset, offset + 3):
+                out[i, j] -= energy_weight * x[i] * x[j] / (energy * energy * energy)
+
+    if tag_weight != 0.0:
+        tag_mass = math.sqrt(_tag_mass_sq(x))
+        tag_mass_grad = (
+            -x[0] / tag_mass,
+            -x[1] / tag_mass,
+            -x[2] / tag_mass,
+            x[3] / tag_mass,
+        )
+        scale = tag_weight / tag_mass
+        for i in range(4):
+            out[i, i] += scale if i == 3 else -scale
+            for j in range(4):
+                out[i, j] -= scale * tag_mass_grad[i] * tag_mass_grad[j]
+
+    if sig_weight != 0.0:
+        sig_three_momentum = (_sig_x_mom(x), _sig_y_mom(x), _sig_z_mom(x))
+        energy_grad = np.zeros(x.size)
+        mass_grad = np.zeros(x.size)
+        energy_grad[7] = 1.0
+        mass_grad[7] = sig_energy / sig_mass
+        for i in range(3):
+            energy_grad[8 + i] = x[8 + i] / lepton_energy
+            energy_grad[11 + i] = x[11 + i] / neutrino_energy
+            mass_grad[4 + i] = -sig_three_momentum[i] / sig_mass
+            mass_grad[8 + i] = (
+                sig_energy * energy_grad[8 + i] - sig_three_momentum[i]
+            ) / sig_mass
+            mass_grad[11 + i] = (
+                sig_energy * energy_grad[11 + i] - sig_three_momentum[i]
+            ) / sig_mass
+
+        scale = sig_weight / sig_mass
+        for i in range(4, x.size):
+            for j in range(4, x.size):
+                h = energy_grad[i] * energy_grad[j] - mass_grad[i] * mass_grad[j]
+                direction = _SIG_MOMENTUM_DIRECTION[i]
+                if direction >= 0 and direction == _SIG_MOMENTUM_DIRECTION[j]:
+                    h -= 1.0
+                out[i, j] += scale * h
+
+
+@numba.njit(**_JIT_OPTIONS)
+def _merit_function(
+    x: np.ndarray,
+    whitening_matrix: np.ndarray,
+    meas: np.ndarray,
+    beam_momentum: np.ndarray,
+    lepton_mass: float,
+    constraint_index: np.ndarray,
+    penalty: float,
+    cons: np.ndarray,
+) -> float:
+    """Calculates the l1 merit function chi square + penalty * sum(|c|) used for
+    the line search of :func:`_fit_batch`. `cons` is used as buffer for the
+    constraints.
+    """
+    _fill_eq_constraints(x, beam_momentum, lepton_mass, constraint_index, cons)
+    merit = _chi_square_function(x, whitening_matrix, meas)
+    for j in range(cons.size):
+        merit += penalty * abs(cons[j])
+    return merit
+
+
+@numba.njit(**_JIT_OPTIONS)
+def _min_reduced_curvature(hessian: np.ndarray, jac: np.ndarray) -> float:
+    """Calculates the smallest eigenvalue of the reduced Hessian Z^T H Z, where
+    the columns of Z span the null space of the constraint Jacobian `jac`, i.e.
+    the smallest curvature of the Lagrangian along the constraints.
+
+    :param hessian: Hessian of the Lagrangian of shape (14, 14)
+    :type hessian: np.ndarray
+    :param jac: Jacobian of the constraints of shape (m, 14)
+    :type jac: np.ndarray
+    :return: Smallest eigenvalue of the reduced Hessian, inf if the null space is
+    empty
+    :rtype: float
+    """
+    _, singular_values, vt = np.linalg.svd(jac)
+    rank = 0
+    for singular_value in singular_values:
+        if singular_value > 1e-10 * singular_values[0]:
+            rank += 1
+    if rank == jac.shape[1]:
+        return np.inf
+
+    null_space = np.ascontiguousarray(vt[rank:].T)
+    return np.linalg.eigvalsh(null_space.T @ hessian @ null_space)[0]
+
+
+# settings of the step control of _fit_batch: the Hessian is shifted by the
+# smallest reduced curvature times (1 + _CONVEXIFICATION_MARGIN) if it is negative.
+# The step is halved at most _MAX_STEP_HALVINGS times per damping, which is
+# increased by _DAMPING_FACTOR (at least to _INITIAL_DAMPING) at most
+# _MAX_DAMPING_ATTEMPTS times.
+_CONVEXIFICATION_MARGIN = 1e-3
+_MAX_STEP_HALVINGS = 7
+_INITIAL_DAMPING = 1.0
+_DAMPING_FACTOR = 10.0
+_MAX_DAMPING_ATTEMPTS = 8
+
+
+@numba.njit(parallel=True, **_JIT_OPTIONS)
+def _fit_batch(
+    x0: np.ndarray,
+    whitening_matrix: np.ndarray,
+    meas: np.ndarray,
+    beam_momentum: np.ndarray,
+    lepton_mass: np.ndarray,
+    constraint_index: np.ndarray,
+    max_iterations: int,
+    tolerance: float,
+):
+    """Fits N events in parallel with the Lagrange multiplier method. Each
+    iteration is a Newton step on the Lagrangian of the chi square of
+    :func:`_chi_square_function` and the equality constraints selected by
+    `constraint_index`, i.e. the KKT system
+
+        [ H + mu I  A^T ] [ dx ]   [ -g ]
+        [    A       0  ] [ l  ] = [ -c ]
+
+    is solved, where g is the gradient of the chi square, c and A the
+    constraints and their Jacobian (:func:`_fill_eq_constraints`) and H the Hessian
+    of the Lagrangian with the multipliers l of the previous iteration
+    (:func:`_add_eq_constraints_hessian`). The system is solved in the least
+    squares sense, so redundant constraints don't make it singular.
+
+    If H has negative curvature along the constraints
+    (:func:`_min_reduced_curvature`), the damping mu is chosen to remove it, so
+    the step doesn't lead to a saddle point. If the full step increases the
+    merit function (:func:`_merit_function`), a second order correction for the
+    curvature of the constraints is tried, then the step is shortened and
+    finally the Levenberg-Marquardt damping mu is increased. A fit has converged
+    once the constraints and the step are below `tolerance` and the curvature
+    along the constraints is positive, i.e. at a minimum. All arguments except
+    the constraint index and the settings are stacked along the first axis,
+    e.g. `x0` has the shape (N, 14).
+
+    :return: Fitted parameters (N, 14), chi square sums (N,), number of
+    iterations (N,), whether the fit converged (N,) and the Lagrange multipliers
+    (N, len(constraint_index))
+    :rtype: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+    """
+    n_events, n_params = x0.shape
+    n_cons = constraint_index.size
+    n_kkt = n_params + n_cons
+
+    x = x0.copy()
+    chi_square = np.empty(n_events)
+    n_iterations = np.zeros(n_events, dtype=np.int64)
+    converged = np.zeros(n_events, dtype=np.bool_)
+    multipliers = np.zeros((n_events, n_cons))
+
+    for i in numba.prange(n_events):
+        x_i = x[i]
+        multipliers_i = multipliers[i]
+        trial_x = np.empty(n_params)
+        direction = np.empty(n_params)
+        kkt = np.zeros((n_kkt, n_kkt))
+        rhs = np.empty(n_kkt)
+        correction_rhs = np.zeros(n_kkt)
+        cons = np.empty(n_cons)
+        trial_cons = np.empty(n_cons)
+        jac = np.empty((n_cons, n_params))
+        lagrangian_hessian = np.empty((n_params, n_params))
+
+        # the chi square is quadratic, its Hessian 2 W^T W is constant and has the
+        # blocks of the whitening matrix
+        chi_square_hessian = np.zeros((n_params, n_params))
+        for start, stop in _MEASURED_PARAM_BLOCKS:
+            for j in range(start, stop):
+                for k in range(start, stop):
+                    h = 0.0
+                    for l in range(max(j, k), stop):
+                        h += whitening_matrix[i, l, j] * whitening_matrix[i, l, k]
+                    chi_square_hessian[j, k] = 2 * h
+
+        for iteration in range(max_iterations):
+            _fill_eq_constraints(
+                x_i, beam_momentum[i], lepton_mass[i], constraint_index, cons
+            )
+            _fill_eq_constraints_jac(
+                x_i, beam_momentum[i], lepton_mass[i], constraint_index, jac
+            )
+            grad = _chi_square_gradient(x_i, whitening_matrix[i], meas[i])
+
+            # e.g. an unphysical mass squared, the fit can't be continued
+            if not (np.all(np.isfinite(cons)) and np.all(np.isfinite(jac))):
+                break
+
+            for j in range(n_cons):
+                rhs[n_params + j] = -cons[j]
+                for k in range(n_params):
+                    kkt[n_params + j, k] = kkt[k, n_params + j] = jac[j, k]
+            for k in range(n_params):
+                rhs[k] = -grad[k]
+
+            lagrangian_hessian[:] = chi_square_hessian
+            _add_eq_constraints_hessian(
+                x_i, lepton_mass[i], constraint_index, multipliers_i, lagrangian_hessian
+            )
+            min_curvature = _min_reduced_curvature(lagrangian_hessian, jac)
+            damping = 0.0
+            if min_curvature < 0:
+                damping = -min_curvature * (1 + _CONVEXIFICATION_MARGIN)
+
+            accepted = False
+            for _ in range(_MAX_DAMPING_ATTEMPTS):
+                kkt[:n_params, :n_params] = lagrangian_hessian
+                for k in range(n_params):
+                    kkt[k, k] += damping
+
+                step = np.linalg.lstsq(kkt, rhs)[0]
+                penalty = 0.0
+                for j in range(n_cons):
+                    penalty = max(penalty, 1.1 * abs(step[n_params + j]))
+
+                merit = _merit_function(
+                    x_i,
+                    whitening_matrix[i],
+                    meas[i],
+                    beam_momentum[i],
+                    lepton_mass[i],
+                    constraint_index,
+                    penalty,
+                    trial_cons,
+                )
+                for k in range(n_params):
+                    direction[k] = step[k]
+                    trial_x[k] = x_i[k] + step[k]
+                full_step_merit = _merit_function(
+                    trial_x,
+                    whitening_matrix[i],
+                    meas[i],
+                    beam_momentum[i],
+                    lepton_mass[i],
+                    constraint_index,
+                    penalty,
+                    trial_cons,
+                )
+                if full_step_merit > merit:
+                    # second order correction, trial_cons holds the constraints
+                    # after the full step
+                    for j in range(n_cons):
+                        correction_rhs[n_params + j] = -trial_cons[j]
+                    correction = np.linalg.lstsq(kkt, correction_rhs)[0]
+                    for k in range(n_params):
+                        trial_x[k] += correction[k]
+                    corrected_merit = _merit_function(
+                        trial_x,
+                        whitening_matrix[i],
+                        meas[i],
+                        beam_momentum[i],
+                        lepton_mass[i],
+                        constraint_index,
+                        penalty,
+                        trial_cons,
+                    )
+                    if corrected_merit <= merit:
+                        for k in range(n_params):
+                            direction[k] += correction[k]
+
+                step_length = 1.0
+                for _ in range(_MAX_STEP_HALVINGS):
+                    for k in range(n_params):
+                        trial_x[k] = x_i[k] + step_length * direction[k]
+                    trial_merit = _merit_function(
+                        trial_x,
+                        whitening_matrix[i],
+                        meas[i],
+                        beam_momentum[i],
+                        lepton_mass[i],
+                        constraint_index,
+                        penalty,
+                        trial_cons,
+                    )
+                    if trial_merit <= merit:
+                        accepted = True
+                        break
+                    step_length *= 0.5
+
+                if accepted:
+                    break
+                damping = max(_DAMPING_FACTOR * damping, _INITIAL_DAMPING)
+
+            if not accepted:
+                break
+
+            max_step = 0.0
+            for k in range(n_params):
+                max_step = max(max_step, abs(trial_x[k] - x_i[k]))
+                x_i[k] = trial_x[k]
+            multipliers_i[:] = step[n_params:]
+
+            n_iterations[i] = iteration + 1
+            if max_step < tolerance and np.max(np.abs(cons)) < tolerance:
+                # a stationary point with negative curvature is a saddle point
+                converged[i] = min_curvature >= 0
+                break
+
+        chi_square[i] = _chi_square_function(x_i, whitening_matrix[i], meas[i])
+
+    return x, chi_square, n_iterations, converged, multipliers
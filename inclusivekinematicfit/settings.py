@@ -29,7 +29,7 @@ def set_setting(key: str, value: Any) -> None:
     """Set the setting with the specified name.
     """
 
-    if key in _kinfit_global_settings.keys():
+    if key in _kinfit_global_settings:
         warnings.warn(
             f"You're overwriting the following setting {key}: {_kinfit_global_settings[key]} -> {value}.",
             OverwritingSettingsWarning,
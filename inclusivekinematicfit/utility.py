@@ -1,7 +1,7 @@
 from typing import NamedTuple
 
 import numpy as np
-import scipy.stats
+import scipy.special
 
 __all__ = [
     "MassiveParticleKinematicInfo",
@@ -46,7 +46,12 @@ def calculate_chi2_prob(chi2_values: np.ndarray, ndf: int) -> np.ndarray:
     :param ndf: Number of degrees of freedom for the
     chi square distribution
     :type ndf: int
+    :raises ValueError: Raised if `ndf` is not positive.
     :return: Calculated p-values
     :rtype: np.ndarray
     """
-    return 1 - scipy.stats.chi2.cdf(chi2_values, df=ndf)
+    if ndf <= 0:
+        raise ValueError(f"Number of degrees of freedom has to be positive, got {ndf}")
+
+    # survival function of the chi square distribution, 1 - P(ndf / 2, chi2 / 2)
+    return scipy.special.gammaincc(0.5 * ndf, 0.5 * np.asarray(chi2_values))
@@ -0,0 +1,301 @@
+import logging
+
+import pytest
+import numpy as np
+import scipy.linalg
+
+import inclusivekinematicfit
+from inclusivekinematicfit import funclib
+from inclusivekinematicfit.chi2functions import DefaultKinematicFitCostFunction
+from inclusivekinematicfit.utility import (
+    MassConstrainedParticleKinematicInfo,
+    MassiveParticleKinematicInfo,
+    MasslessParticleKinematicInfo,
+)
+
+BEAM = np.array([0.0, 0.0, 0.0, 10.58])
+LEPTON_MASS = 0.1057
+
+
+def create_cost_function(seed=0, **kwargs):
+    rng = np.random.default_rng(seed)
+
+    tag_cov = np.diag([0.01, 0.01, 0.01, 0.02]) + 0.002
+    x_cov = np.diag([0.05, 0.05, 0.05, 0.08]) + 0.01
+    lep_cov = np.diag([1e-4, 1e-4, 1e-4])
+
+    b_momentum = rng.normal(scale=0.2, size=3)
+    tag_energy = np.sqrt(5.279**2 + b_momentum @ b_momentum)
+    lepton = rng.normal(scale=0.8, size=3)
+    neutrino = rng.normal(scale=0.5, size=3)
+    x_momentum = -b_momentum - lepton - neutrino
+    x_energy = (
+        BEAM[3]
+        - tag_energy
+        - np.sqrt(lepton @ lepton + LEPTON_MASS**2)
+        - np.sqrt(neutrino @ neutrino)
+    )
+
+    tag_meas = np.array([*b_momentum, tag_energy]) + rng.multivariate_normal(
+        np.zeros(4), tag_cov
+    )
+    x_meas = np.array([*x_momentum, x_energy]) + rng.multivariate_normal(
+        np.zeros(4), x_cov
+    )
+    lep_meas = lepton + rng.multivariate_normal(np.zeros(3), lep_cov)
+
+    return DefaultKinematicFitCostFunction(
+        MassiveParticleKinematicInfo(tag_cov, tag_meas),
+        MassConstrainedParticleKinematicInfo(lep_cov, lep_meas, LEPTON_MASS),
+        MassiveParticleKinematicInfo(x_cov, x_meas),
+        MasslessParticleKinematicInfo(BEAM[:3] - tag_meas[:3] - x_meas[:3] - lep_meas),
+        BEAM,
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize(
+    "constraint_list",
+    [
+        ["px", "py", "pz", "E", "mbsig", "mbtag", "mx2"],
+        ["px", "py", "pz", "E", "mbequal", "mx2"],
+    ],
+)
+def test_minimize(constraint_list):
+    cost_function = create_cost_function(constraint_list=constraint_list)
+    result = inclusivekinematicfit.minimize(cost_function)
+
+    assert result.success
+    for constraint in cost_function.constraints:
+        value = constraint["fun"](result.x, *constraint.get("args", ()))
+        if constraint["type"] == "eq":
+            np.testing.assert_allclose(value, 0, atol=1e-6)
+        else:
+            assert np.all(value >= -1e-6)
+
+
+def test_not_positive_definite_covariance(caplog):
+    cost_function = create_cost_function()
+    caplog.set_level(logging.DEBUG, logger="inclusivekinematicfit.chi2functions")
+    with pytest.raises(ValueError):
+        DefaultKinematicFitCostFunction(
+            MassiveParticleKinematicInfo(
+                -np.eye(4), cost_function.tag_side_measured_momentum
+            ),
+            MassConstrainedParticleKinematicInfo(
+                cost_function.lepton_cov,
+                cost_function.lepton_measured_three_momentum,
+                LEPTON_MASS,
+            ),
+            MassiveParticleKinematicInfo(
+                cost_function.x_system_cov, cost_function.x_system_measured_momentum
+            ),
+            MasslessParticleKinematicInfo(
+                cost_function.neutrino_measured_three_momentum
+            ),
+            BEAM,
+        )
+    assert "not positive definite" in caplog.text
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_minimize_batch(max_workers):
+    cost_functions = [create_cost_function(seed) for seed in range(4)]
+
+    results = inclusivekinematicfit.minimize_batch(
+        cost_functions, max_workers=max_workers
+    )
+
+    assert len(results) == len(cost_functions)
+    for cost_function, result in zip(cost_functions, results):
+        expected = inclusivekinematicfit.minimize(cost_function)
+        np.testing.assert_allclose(result.x, expected.x)
+
+
+def test_constraint_buffers_not_shared():
+    # every minimize call gets new constraint output buffers, so fits of the same
+    # cost function in several threads don't overwrite each other's values
+    cost_function = create_cost_function()
+
+    first_args, second_args = (cost_function.constraints[0]["args"] for _ in range(2))
+
+    for first_buffer, second_buffer in zip(first_args[-2:], second_args[-2:]):
+        assert not np.shares_memory(first_buffer, second_buffer)
+
+
+def test_measured_param_blocks():
+    cost_function = create_cost_function()
+    with pytest.raises(ValueError, match="measured parameters"):
+        DefaultKinematicFitCostFunction(
+            MassiveParticleKinematicInfo(
+                cost_function.tag_side_cov[:3, :3],
+                cost_function.tag_side_measured_momentum,
+            ),
+            MassConstrainedParticleKinematicInfo(
+                cost_function.lepton_cov,
+                cost_function.lepton_measured_three_momentum,
+                LEPTON_MASS,
+            ),
+            MassiveParticleKinematicInfo(
+                cost_function.x_system_cov, cost_function.x_system_measured_momentum
+            ),
+            MasslessParticleKinematicInfo(
+                cost_function.neutrino_measured_three_momentum
+            ),
+            BEAM,
+        )
+
+    # the whitening matrix is built block by block, so it is block diagonal
+    np.testing.assert_allclose(
+        cost_function.measured_params_whitening_matrix,
+        scipy.linalg.block_diag(
+            np.linalg.inv(cost_function.tag_side_cov_cholesky),
+            np.linalg.inv(cost_function.x_system_cov_cholesky),
+            np.linalg.inv(cost_function.lepton_cov_cholesky),
+        ),
+        atol=1e-12,
+    )
+
+
+def test_unknown_constraint():
+    with pytest.raises(ValueError):
+        create_cost_function(constraint_list=["px", "py", "pz", "E", "mb"])
+
+
+def test_inputs_converted_to_contiguous_float_arrays():
+    cost_function = create_cost_function()
+    cost_function = DefaultKinematicFitCostFunction(
+        MassiveParticleKinematicInfo(
+            cost_function.tag_side_cov.T, list(cost_function.tag_side_measured_momentum)
+        ),
+        MassConstrainedParticleKinematicInfo(
+            cost_function.lepton_cov,
+            cost_function.lepton_measured_three_momentum,
+            LEPTON_MASS,
+        ),
+        MassiveParticleKinematicInfo(
+            cost_function.x_system_cov, cost_function.x_system_measured_momentum
+        ),
+        MasslessParticleKinematicInfo(cost_function.neutrino_measured_three_momentum),
+        [0, 0, 0, 11],
+    )
+
+    for values in [
+        cost_function.beam_four_momentum,
+        cost_function.tag_side_measured_momentum,
+        cost_function.tag_side_cov,
+        cost_function.tag_side_cov_cholesky,
+    ]:
+        assert values.dtype == np.float64
+        assert values.flags.c_contiguous
+
+    assert inclusivekinematicfit.minimize(cost_function).success
+
+
+@pytest.mark.parametrize(
+    "attribute", ["beam_four_momentum", "lepton_mass", "tag_side_measured_momentum"]
+)
+def test_inputs_read_only(attribute):
+    cost_function = create_cost_function()
+
+    with pytest.raises(AttributeError):
+        setattr(cost_function, attribute, getattr(cost_function, attribute))
+
+
+def test_minimize_warm_start():
+    cost_function = create_cost_function()
+    result = inclusivekinematicfit.minimize(cost_function)
+
+    refit_result = inclusivekinematicfit.minimize(cost_function, x0=result.x)
+
+    assert refit_result.success
+    assert refit_result.nit < result.nit
+    np.testing.assert_allclose(refit_result.fun, result.fun, rtol=1e-6)
+
+    with pytest.raises(ValueError):
+        inclusivekinematicfit.minimize_batch(
+            [cost_function], max_workers=1, x0s=[result.x, result.x]
+        )
+
+
+@pytest.mark.parametrize(
+    "constraint_list",
+    [
+        ["px", "py", "pz", "E", "mbsig", "mbtag", "mx2"],
+        ["px", "py", "pz", "E", "mbsig", "mbtag"],
+    ],
+)
+def test_fit_batch(constraint_list):
+    # the seeds include fits with an active mx2 constraint
+    cost_functions = [
+        create_cost_function(seed, constraint_list=constraint_list)
+        for seed in range(16)
+    ]
+
+    results = inclusivekinematicfit.fit_batch(cost_functions)
+
+    assert len(results) == len(cost_functions)
+    for cost_function, result in zip(cost_functions, results):
+        expected = inclusivekinematicfit.minimize(cost_function)
+        assert result.success
+        np.testing.assert_allclose(result.fun, expected.fun, rtol=1e-6)
+        np.testing.assert_allclose(result.x, expected.x, atol=1e-4)
+        for constraint in cost_function.constraints:
+            value = constraint["fun"](result.x, *constraint.get("args", ()))
+            if constraint["type"] == "eq":
+                np.testing.assert_allclose(value, 0, atol=1e-8)
+            else:
+                assert np.all(value >= -1e-8)
+
+
+def test_fit_batch_reads_measured_param_blocks():
+    # the chi square, its gradient and its Hessian only read the blocks of the
+    # whitening matrix, so entries outside of them must not change the fit
+    cost_functions = [create_cost_function(seed) for seed in range(4)]
+    x0 = np.stack([cf.initial_params for cf in cost_functions])
+    whitening_matrix = np.stack(
+        [cf.measured_params_whitening_matrix for cf in cost_functions]
+    )
+    args = (
+        np.stack([cf.measured_params for cf in cost_functions]),
+        np.stack([cf.beam_four_momentum for cf in cost_functions]),
+        np.full(len(cost_functions), LEPTON_MASS),
+        cost_functions[0].eq_constraint_index,
+        50,
+        1e-8,
+    )
+
+    off_block = np.tril(np.ones(whitening_matrix.shape[1:], dtype=bool), -1)
+    for start, stop in funclib._MEASURED_PARAM_BLOCKS:
+        off_block[start:stop, start:stop] = False
+    perturbed_whitening_matrix = whitening_matrix.copy()
+    perturbed_whitening_matrix[:, off_block] = 1.0
+
+    expected = funclib._fit_batch(x0, whitening_matrix, *args)
+    results = funclib._fit_batch(x0, perturbed_whitening_matrix, *args)
+
+    for result, expected_result in zip(results, expected):
+        np.testing.assert_array_equal(result, expected_result)
+
+
+def test_fit_batch_requires_same_constraints():
+    cost_functions = [
+        create_cost_function(0),
+        create_cost_function(1, constraint_list=["px", "py", "pz", "E"]),
+    ]
+
+    with pytest.raises(ValueError):
+        inclusivekinematicfit.fit_batch(cost_functions)
+
+
+def test_minimize_batch_after_fit_batch():
+    # the parallel kernel of fit_batch starts the numba threading layer, which
+    # must not be inherited by the worker processes of minimize_batch
+    cost_functions = [create_cost_function(seed) for seed in range(4)]
+
+    batch_results = inclusivekinematicfit.fit_batch(cost_functions)
+    results = inclusivekinematicfit.minimize_batch(cost_functions, max_workers=2)
+
+    for batch_result, result in zip(batch_results, results):
+        assert result.success
+        np.testing.assert_allclose(batch_result.fun, result.fun, rtol=1e-6)
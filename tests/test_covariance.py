@@ -1,10 +1,28 @@
 import pytest
 import numpy as np
+import pandas as pd
 
 from inclusivekinematicfit.covariance import (
     number_of_off_diagonal_values,
     create_symmetric_matrix,
+    get_covariance_by_phase_space,
+    get_gaussian_cov_matrix,
+    get_gaussian_cov_matrix_by_phase_space,
+    get_rms_diag_error_matrix,
+    get_rms_error_matrix,
+    get_stacked_covariance_by_phase_space,
 )
+from inclusivekinematicfit.utility import rms
+
+
+@pytest.fixture
+def resolution_df():
+    rng = np.random.default_rng(42)
+    n_rows = 1000
+    df = pd.DataFrame(rng.normal(size=(n_rows, 3)), columns=["dpx", "dpy", "dpz"])
+    df["p_bin"] = pd.cut(rng.uniform(0, 3, size=n_rows), [0, 1, 2, 3])
+    df["theta_bin"] = pd.cut(rng.uniform(0, 1, size=n_rows), [0, 0.5, 1])
+    return df
 
 
 @pytest.mark.parametrize("test_input,expected", [(2, 1), (3, 3), (4, 6)])
@@ -26,3 +44,78 @@ def test_create_symmetric_matrix():
         m = create_symmetric_matrix(4, np.array([1, 2, 3, 4]), np.array([4, 5, 6]))
         m = create_symmetric_matrix(3, np.array([[1, 2, 3]]), np.array([4, 5, 6]))
         m = create_symmetric_matrix(3, np.array([1, 2, 3]), np.array([[4, 5, 6]]))
+
+
+def test_get_stacked_covariance_by_phase_space(resolution_df):
+    columns = ["dpx", "dpy", "dpz"]
+    bin_columns = ["p_bin", "theta_bin"]
+
+    def estimator(df):
+        return get_gaussian_cov_matrix(df, columns)
+
+    cov_mats, bin_index = get_stacked_covariance_by_phase_space(
+        resolution_df, bin_columns, estimator
+    )
+    cov_mat_dict = get_covariance_by_phase_space(resolution_df, bin_columns, estimator)
+
+    assert cov_mats.shape == (6, 3, 3)
+    assert bin_index.shape == (len(resolution_df),)
+    for i, cov_mat in enumerate(cov_mat_dict.values()):
+        np.testing.assert_allclose(cov_mats[i], cov_mat)
+
+    for i, (_, row) in enumerate(resolution_df.head(20).iterrows()):
+        key = (row["p_bin"], row["theta_bin"])
+        np.testing.assert_allclose(cov_mats[bin_index[i]], cov_mat_dict[key])
+
+
+def test_rms_error_matrices(resolution_df):
+    columns = ["dpx", "dpy", "dpz"]
+    rms_values = np.array([rms(resolution_df[column]) for column in columns])
+
+    np.testing.assert_allclose(
+        get_rms_diag_error_matrix(resolution_df, columns), np.diag(rms_values**2)
+    )
+
+    correlation = np.corrcoef(resolution_df[columns], rowvar=False)
+    np.testing.assert_allclose(
+        get_rms_error_matrix(resolution_df, columns),
+        np.diag(rms_values) @ correlation @ np.diag(rms_values),
+    )
+
+
+@pytest.mark.parametrize("bin_columns", [["p_bin", "theta_bin"], ["p_bin"]])
+def test_get_gaussian_cov_matrix_by_phase_space(resolution_df, bin_columns):
+    columns = ["dpx", "dpy", "dpz"]
+
+    cov_mat_dict = get_gaussian_cov_matrix_by_phase_space(
+        resolution_df, bin_columns, columns
+    )
+    expected = get_covariance_by_phase_space(
+        resolution_df,
+        bin_columns,
+        lambda df: get_gaussian_cov_matrix(df, columns),
+    )
+
+    assert list(cov_mat_dict.keys()) == list(expected.keys())
+    for key, cov_mat in expected.items():
+        np.testing.assert_allclose(cov_mat_dict[key], cov_mat)
+
+
+def test_get_gaussian_cov_matrix_by_phase_space_sparse_bins(resolution_df):
+    columns = ["dpx", "dpy", "dpz"]
+    # a bin with a single row and, if the grouping keeps unobserved categories,
+    # an empty bin
+    df = resolution_df.copy()
+    df["p_bin"] = pd.cut(np.where(np.arange(len(df)) == 0, 3.5, 0.5), [0, 1, 2, 3, 4])
+
+    cov_mat_dict = get_gaussian_cov_matrix_by_phase_space(df, ["p_bin"], columns)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        with pytest.warns(RuntimeWarning):
+            expected = get_covariance_by_phase_space(
+                df, ["p_bin"], lambda df: get_gaussian_cov_matrix(df, columns)
+            )
+
+    assert list(cov_mat_dict.keys()) == list(expected.keys())
+    for key, cov_mat in expected.items():
+        np.testing.assert_allclose(cov_mat_dict[key], cov_mat)
+    assert np.all(np.isnan(cov_mat_dict[(pd.Interval(3, 4),)]))
@@ -0,0 +1,170 @@
+import numpy as np
+import scipy.linalg
+
+from inclusivekinematicfit import funclib
+
+BEAM = np.array([0.0, 0.0, 0.0, 10.58])
+LEPTON_MASS = 0.1057
+X = np.array(
+    [0.2, -0.1, 0.15, 5.3, -0.9, 0.4, -0.6, 3.1, 0.5, -0.3, 0.2, 0.2, 0.1, 0.3]
+)
+
+
+def numerical_gradient(f, x, eps=1e-6):
+    grad = np.zeros(x.size)
+    for i in range(x.size):
+        step = np.zeros(x.size)
+        step[i] = eps
+        grad[i] = (f(x + step) - f(x - step)) / (2 * eps)
+    return grad
+
+
+def eq_constraints(x):
+    return funclib._fill_eq_constraints(
+        x, BEAM, LEPTON_MASS, np.arange(7, dtype=np.int64), np.empty(7)
+    )
+
+
+def test_eq_constraints():
+    constraints = [
+        (funclib._x_mom_function, (BEAM,)),
+        (funclib._y_mom_function, (BEAM,)),
+        (funclib._z_mom_function, (BEAM,)),
+        (funclib._E_function, (BEAM, LEPTON_MASS)),
+        (funclib._eq_mass_function, (LEPTON_MASS,)),
+        (funclib._tag_mass_function, ()),
+        (funclib._sig_mass_function, (LEPTON_MASS,)),
+    ]
+
+    np.testing.assert_allclose(
+        eq_constraints(X),
+        [function(X, *args) for function, args in constraints],
+        atol=1e-12,
+    )
+
+
+def test_eq_constraints_jac():
+    constraint_index = np.arange(8, dtype=np.int64)
+
+    def constraints(x):
+        return funclib._fill_eq_constraints(
+            x, BEAM, LEPTON_MASS, constraint_index, np.empty(8)
+        )
+
+    expected = np.stack(
+        [numerical_gradient(lambda x: constraints(x)[i], X) for i in range(8)]
+    )
+    np.testing.assert_allclose(
+        funclib._fill_eq_constraints_jac(
+            X, BEAM, LEPTON_MASS, constraint_index, np.empty((8, X.size))
+        ),
+        expected,
+        rtol=1e-6,
+        atol=1e-8,
+    )
+
+
+def test_x_mass_jac():
+    np.testing.assert_allclose(
+        funclib._x_mass_jac(X),
+        numerical_gradient(funclib._x_mass_function, X),
+        rtol=1e-6,
+        atol=1e-8,
+    )
+
+
+def test_selected_eq_constraints():
+    constraint_index = np.array([6, 4, 1, 3], dtype=np.int64)
+    out = np.full(constraint_index.size, np.nan)
+    jac_out = np.full((constraint_index.size, X.size), np.nan)
+    args = (BEAM, LEPTON_MASS, constraint_index, out, jac_out)
+
+    cons = funclib._selected_eq_constraints(X, *args)
+    jac = funclib._selected_eq_constraints_jac(X, *args)
+
+    assert cons is out
+    assert jac is jac_out
+    np.testing.assert_allclose(cons, eq_constraints(X)[constraint_index])
+    np.testing.assert_allclose(
+        jac,
+        funclib._fill_eq_constraints_jac(
+            X, BEAM, LEPTON_MASS, constraint_index, np.empty(jac.shape)
+        ),
+    )
+
+
+def test_chi_square_function():
+    rng = np.random.default_rng(42)
+    covs = [
+        np.diag([0.01, 0.01, 0.01, 0.02]) + 0.002,
+        np.diag([0.05, 0.05, 0.05, 0.08]) + 0.01,
+        np.diag([1e-3, 2e-3, 3e-3]),
+    ]
+    meas = [
+        X[0:4] + rng.normal(scale=0.1, size=4),
+        X[4:8] + rng.normal(scale=0.2, size=4),
+        X[8:11] + rng.normal(scale=0.01, size=3),
+    ]
+    args = (
+        np.linalg.inv(scipy.linalg.block_diag(*map(np.linalg.cholesky, covs))),
+        np.concatenate(meas),
+    )
+
+    expected = sum(
+        r @ np.linalg.inv(cov) @ r
+        for r, cov in zip([X[0:4] - meas[0], X[4:8] - meas[1], X[8:11] - meas[2]], covs)
+    )
+    np.testing.assert_allclose(
+        funclib._chi_square_function(X, *args), expected, rtol=1e-10
+    )
+    np.testing.assert_allclose(
+        funclib._chi_square_gradient(X, *args),
+        numerical_gradient(lambda x: funclib._chi_square_function(x, *args), X),
+        rtol=1e-6,
+        atol=1e-6,
+    )
+
+
+def test_unphysical_mass_is_nan():
+    x = X.copy()
+    x[3] = 0.0
+
+    assert np.isnan(funclib._tag_mass_function(x))
+    assert np.isnan(eq_constraints(x)[5])
+
+
+def test_eq_constraints_hessian():
+    constraint_index = np.arange(8, dtype=np.int64)
+    multipliers = np.array([0.3, -0.2, 0.5, 1.1, -0.7, 0.4, 0.9, -0.6])
+
+    hessian = np.zeros((X.size, X.size))
+    funclib._add_eq_constraints_hessian(
+        X, LEPTON_MASS, constraint_index, multipliers, hessian
+    )
+
+    def jacobian(x):
+        return funclib._fill_eq_constraints_jac(
+            x, BEAM, LEPTON_MASS, constraint_index, np.empty((8, X.size))
+        )
+
+    expected = np.stack(
+        [
+            numerical_gradient(lambda x: multipliers @ jacobian(x)[:, i], X)
+            for i in range(X.size)
+        ]
+    )
+    np.testing.assert_allclose(hessian, expected, atol=1e-6)
+
+
+def test_x_mass_sq_constraint():
+    constraint_index = np.array([funclib._X_MASS_SQ_CONSTRAINT], dtype=np.int64)
+    out = np.empty(1)
+    jac_out = np.empty((1, X.size))
+    args = (BEAM, LEPTON_MASS, constraint_index, out, jac_out)
+
+    np.testing.assert_allclose(
+        funclib._selected_eq_constraints(X, *args), [funclib._x_mass_function(X)]
+    )
+    np.testing.assert_allclose(
+        funclib._selected_eq_constraints_jac(X, *args), [funclib._x_mass_jac(X)]
+    )
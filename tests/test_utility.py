@@ -1,3 +1,4 @@
+import pytest
 import numpy as np
 
 from inclusivekinematicfit.utility import calculate_chi2_prob
@@ -10,3 +11,8 @@ def test_calculate_chi2_prob():
     chi2_probs = calculate_chi2_prob(test_vals[0], ndf=ndf)
 
     np.testing.assert_almost_equal(chi2_probs, test_vals[1], decimal=4)
+
+
+def test_calculate_chi2_prob_invalid_ndf():
+    with pytest.raises(ValueError):
+        calculate_chi2_prob(np.array([1, 2, 3]), ndf=0)